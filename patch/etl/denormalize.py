@@ -0,0 +1,230 @@
+"""Flat elastic search documents from nested GraphQL records, driven by a declarative mapping."""
+
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from operator import itemgetter
+from typing import List
+
+import yaml
+
+try:
+    import orjson
+
+    def dumps(obj):
+        """Serialize obj to a json str."""
+        return orjson.dumps(obj).decode()
+except ImportError:
+    dumps = json.dumps
+
+MAPPING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tube_lite_mapping.yaml')
+"""Default mapping of tube_lite's indices."""
+
+DEFAULT_FIRST = 10
+"""peregrine's limit of a field queried without `first`, `first: 0` is no limit."""
+
+_TOKENS = re.compile(r'"[^"]*"|\$?\w+|[{}():]')
+
+_MISSING = object()
+"""A document prop that is not set."""
+
+
+@dataclass
+class Field(object):
+    """A field of a GraphQL selection."""
+    alias: str
+    """Key in the response."""
+    name: str
+    """Property or link name."""
+    args: dict = field(default_factory=dict)
+    fields: List['Field'] = None
+    """Selection of a link, None for a property."""
+
+    @property
+    def first(self):
+        """Linked records per parent, 0 for all."""
+        return int(self.args.get('first', DEFAULT_FIRST))
+
+
+def _selection(tokens, i):
+    """Parse the selection starting at tokens[i] == '{', return its fields and the index after it."""
+    assert tokens[i] == '{', tokens[i:i + 5]
+    i += 1
+    fields = {}
+    while tokens[i] != '}':
+        alias = name = tokens[i]
+        i += 1
+        if tokens[i] == ':':
+            name = tokens[i + 1]
+            i += 2
+        args = {}
+        if tokens[i] == '(':
+            i += 1
+            while tokens[i] != ')':
+                args[tokens[i]] = tokens[i + 2].strip('"')
+                i += 3
+            i += 1
+        fields_ = None
+        if tokens[i] == '{':
+            fields_, i = _selection(tokens, i)
+        # graphql merges repeated fields, the first one sets the order
+        fields.setdefault(alias, Field(alias, name, args, fields_))
+    return list(fields.values()), i + 1
+
+
+def parse_query(graphql) -> Field:
+    """Return the root field of a single root GraphQL query, variables are left as $names."""
+    tokens = _TOKENS.findall(graphql)
+    fields, _ = _selection(tokens, tokens.index('{'))
+    assert len(fields) == 1, f"Expected one root field {[f.alias for f in fields]}"
+    return fields[0]
+
+
+class Shared(object):
+    """Fields shared by all documents of a root record, serialized once."""
+    __slots__ = ('fields', '_json')
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._json = None
+
+    @property
+    def json(self):
+        """The members of the json object, without braces."""
+        if self._json is None:
+            self._json = dumps(self.fields)[1:-1]
+        return self._json
+
+
+class Document(object):
+    """A flat document: its own fields, merged with the shared ones when it is serialized."""
+    __slots__ = ('fields', 'shared')
+
+    def __init__(self, fields, shared):
+        self.fields = fields
+        self.shared = shared
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return self.fields[key]
+        return self.shared.fields[key]
+
+    def to_dict(self):
+        document = dict(self.shared.fields)
+        document.update(self.fields)
+        return document
+
+    def to_json(self):
+        own = dumps(self.fields)
+        shared = self.shared.json
+        if not shared:
+            return own
+        if own == '{}':
+            return f"{{{shared}}}"
+        return f"{own[:-1]},{shared}}}"
+
+
+def as_dict(document):
+    """A Document or dict as a dict."""
+    return document.to_dict() if isinstance(document, Document) else document
+
+
+def _auth_resource_path(project_id, prop):
+    program, project = project_id.split('-')
+    return f"/programs/{program}/projects/{project}"
+
+
+def _extension(value, prop):
+    return value.split('.')[-1] if value else prop.get('default')
+
+
+def _lookup(value, prop):
+    return prop['values'].get(value, _MISSING)
+
+
+def _int(value, prop):
+    return int(value) if value else prop.get('default')
+
+
+FUNCTIONS = {
+    'copy': lambda value, prop: value,
+    'auth_resource_path': _auth_resource_path,
+    'extension': _extension,
+    'lookup': _lookup,
+    'int': _int,
+}
+"""Functions of computed_props and document_props, (value of src, prop) -> value, _MISSING leaves it unset."""
+
+
+def _fields_by_alias(field_, path):
+    """Return {alias: Field} of the selection at path, a link alias of field_."""
+    fields = {f.alias: f for f in field_.fields}
+    if path:
+        assert path in fields and fields[path].fields is not None, f"{path} is not a link of {field_.name}"
+        return {f.alias: f for f in fields[path].fields}
+    return fields
+
+
+def compile_mapping(mapping, graphql):
+    """Return denormalize(record) yielding a Document per element of mapping['explode'] of a root record.
+
+    The props are resolved against the query's selection once, so a record is mapped with plain key lookups and
+    the shared props are computed and serialized once per root record. Document fields win over shared ones.
+    """
+    root = parse_query(graphql)
+    assert root.name == mapping['root'], f"{mapping['name']} maps {mapping['root']}, the query reads {root.name}"
+    selection = _fields_by_alias(root, None)
+    explode = mapping['explode']
+    exploded = _fields_by_alias(root, explode)
+
+    shared = []
+    for prop in mapping.get('props', []):
+        if 'prefix' in prop:
+            shared.extend((alias, itemgetter(alias)) for alias, f in selection.items()
+                          if alias.startswith(prop['prefix']) and f.fields is None)
+        else:
+            assert prop['name'] in selection, f"{prop['name']} is not selected"
+            shared.append((prop['name'], itemgetter(prop['name'])))
+    for prop in mapping.get('computed_props', []):
+        fn = FUNCTIONS[prop.get('fn', 'copy')]
+        src = prop.get('src', prop['name'])
+        if prop.get('path'):
+            shared.append((prop['name'], lambda record, path=prop['path'], src=src, fn=fn, prop=prop:
+                           fn(record[path][0][src], prop)))
+        else:
+            shared.append((prop['name'], lambda record, src=src, fn=fn, prop=prop: fn(record[src], prop)))
+    for prop in mapping.get('flatten_props', []):
+        path = prop.get('path')
+        prefix = prop.get('prefix', '')
+        for alias in _fields_by_alias(root, path):
+            if path:
+                shared.append((f"{prefix}{alias}", lambda record, path=path, alias=alias: record[path][0][alias]))
+            elif alias != explode:
+                shared.append((f"{prefix}{alias}", itemgetter(alias)))
+    for prop in mapping.get('aggregated_props', []):
+        assert prop.get('fn', 'list') == 'list', f"Unsupported aggregation {prop['fn']}"
+        shared.append((prop['name'], lambda record, path=prop['path'], src=prop['src']:
+                       [item[src] for item in record[path]]))
+
+    document_props = [(prop['name'], prop.get('src', prop['name']), FUNCTIONS[prop.get('fn', 'copy')], prop)
+                      for prop in mapping.get('document_props', [])]
+    document_keys = set(exploded) | {name for name, _, _, _ in document_props}
+    shared = [(name, get) for name, get in shared if name not in document_keys]
+
+    def denormalize(record):
+        shared_ = Shared({name: get(record) for name, get in shared})
+        for fields in record[explode]:
+            for name, src, fn, prop in document_props:
+                value = fn(fields.get(src), prop)
+                if value is not _MISSING:
+                    fields[name] = value
+            yield Document(fields, shared_)
+
+    return denormalize
+
+
+def load_mappings(path=MAPPING_PATH):
+    """Return {name: mapping}."""
+    with open(path) as fp:
+        return {mapping['name']: mapping for mapping in yaml.safe_load(fp)['mappings']}
@@ -1,9 +1,26 @@
 # see https://github.com/uc-cdis/pelican/blob/master/pelican/dictionary.py
 
 import itertools
+import json
 from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+from types import MappingProxyType
+from typing import Mapping, Tuple
 
 from dictionaryutils import DataDictionary, dictionary
+from pfb.base import decode_enum
+
+try:
+    import orjson
+
+    def dumps(obj):
+        """Serialize obj to a json str."""
+        return orjson.dumps(obj).decode()
+except ImportError:
+    dumps = json.dumps
+
+EMPTY_JSON = dumps({})
 
 
 def init_dictionary(url):
@@ -16,9 +33,63 @@ def init_dictionary(url):
     return d, md
 
 
+@dataclass(frozen=True)
+class DictionaryIndex:
+    """Read only lookup tables derived from the data model."""
+    node_table_by_label: Mapping[str, str]
+    node_label_by_table: Mapping[str, str]
+    edge_table_by_labels: Mapping[Tuple[str, str], str]
+    edge_labels_by_table: Mapping[str, Mapping[str, str]]
+    edges_by_node: Mapping[str, Tuple[str, ...]]
+
+
 class DataDictionaryTraversal:
     def __init__(self, model):
         self.model = model
+        self._index = None
+
+    @property
+    def index(self):
+        """Lookup tables, built on first use and cached until `invalidate`."""
+        if self._index is None:
+            self._index = self._build_index()
+        return self._index
+
+    def invalidate(self, model=None):
+        """Discard the cached lookup tables, call when the dictionary changes."""
+        if model is not None:
+            self.model = model
+        self._index = None
+
+    def _build_index(self):
+        nodes = self.get_nodes()
+        edges = self.get_edges()
+        label_by_class = {}
+        for edge in edges:
+            for class_name in (edge.__src_class__, edge.__dst_class__):
+                if class_name not in label_by_class:
+                    label_by_class[class_name] = self.model.Node.get_subclass_named(class_name).label
+
+        edges_by_node = defaultdict(list)
+        for edge in edges:
+            edges_by_node[label_by_class[edge.__src_class__]].append(edge.__tablename__)
+
+        return DictionaryIndex(
+            node_table_by_label=MappingProxyType({str(node.label): node.__tablename__ for node in nodes}),
+            node_label_by_table=MappingProxyType({node.__tablename__: str(node.label) for node in nodes}),
+            edge_table_by_labels=MappingProxyType({
+                (label_by_class[edge.__src_class__], label_by_class[edge.__dst_class__]): edge.__tablename__
+                for edge in edges
+            }),
+            edge_labels_by_table=MappingProxyType({
+                edge.__tablename__: MappingProxyType({
+                    "src": label_by_class[edge.__src_class__],
+                    "dst": label_by_class[edge.__dst_class__],
+                })
+                for edge in edges
+            }),
+            edges_by_node=MappingProxyType({label: tuple(tables) for label, tables in edges_by_node.items()}),
+        )
 
     def get_nodes(self):
         return self.model.Node.__subclasses__()
@@ -27,47 +98,19 @@ class DataDictionaryTraversal:
         return self.model.Edge.__subclasses__()
 
     def get_node_table_by_label(self):
-        nodes = self.get_nodes()
-        node_tables = {str(node.label): node.__tablename__ for node in nodes}
-        return node_tables
+        return self.index.node_table_by_label
 
     def get_node_label_by_table(self):
-        nodes = self.get_nodes()
-        node_tables = {node.__tablename__: str(node.label) for node in nodes}
-        return node_tables
+        return self.index.node_label_by_table
 
     def get_edge_table_by_labels(self):
-        edges = self.get_edges()
-        edge_tables = {
-            (
-                self.model.Node.get_subclass_named(edge.__src_class__).label,
-                self.model.Node.get_subclass_named(edge.__dst_class__).label,
-            ): edge.__tablename__
-            for edge in edges
-        }
-        return edge_tables
+        return self.index.edge_table_by_labels
 
     def get_edge_labels_by_table(self):
-        edges = self.get_edges()
-        edge_tables = {
-            edge.__tablename__: {
-                "src": self.model.Node.get_subclass_named(edge.__src_class__).label,
-                "dst": self.model.Node.get_subclass_named(edge.__dst_class__).label,
-            }
-            for edge in edges
-        }
-        return edge_tables
+        return self.index.edge_labels_by_table
 
     def get_edges_by_node(self):
-        edges = self.get_edges()
-        it = defaultdict(list)
-
-        for edge in edges:
-            it[self.model.Node.get_subclass_named(edge.__src_class__).label].append(
-                edge.__tablename__
-            )
-
-        return it
+        return self.index.edges_by_node
 
     def _get_bfs(self, node_name):
         queue = [node_name]
@@ -188,3 +231,57 @@ def convert_to_edge(x, edge_tables):
         )
         for i in x["relations"]
     ]
+
+
+class RecordConverter:
+    """Convert PFB records to node and edge rows.
+
+    The enum fields of each node type are looked up once, all rows of a batch share one `created`
+    timestamp and the empty acl, _sysan and edge _props values are serialized once.
+    """
+
+    def __init__(self, is_base64, edge_tables, project_id=None):
+        self.enum_fields = {
+            name: tuple(field for field, is_enum in fields.items() if is_enum)
+            for name, fields in is_base64.items()
+        }
+        self.edge_tables = edge_tables
+        self.project_id = project_id
+        self.created = datetime.now()
+
+    def start_batch(self):
+        """Take a new `created` timestamp for the rows that follow."""
+        self.created = datetime.now()
+
+    def to_node(self, x):
+        obj = x["object"]
+        for name in self.enum_fields[x["name"]]:
+            value = obj.get(name)
+            if value:
+                obj[name] = decode_enum(value)
+        if self.project_id:
+            obj['project_id'] = self.project_id
+
+        return {
+            "created": self.created,
+            "acl": EMPTY_JSON,
+            "_sysan": EMPTY_JSON,
+            "_props": dumps(obj),
+            "node_id": x["id"],
+        }
+
+    def to_edges(self, x):
+        return [
+            (
+                self.edge_tables[(x["name"], i["dst_name"])],
+                {
+                    "created": self.created,
+                    "acl": EMPTY_JSON,
+                    "_sysan": EMPTY_JSON,
+                    "_props": EMPTY_JSON,
+                    "src_id": x["id"],
+                    "dst_id": i["dst_id"],
+                },
+            )
+            for i in x["relations"]
+        ]
@@ -0,0 +1,203 @@
+import itertools
+import time
+import uuid
+from collections import defaultdict
+
+from psycopg2.sql import Identifier, SQL
+
+from dictionary import RecordConverter
+from import_pfb import CopyWriter
+
+NAMESPACE = uuid.UUID('6f5f3f0c-5b0e-4c5a-9d6e-9a3c2b1e7d10')
+"""node_id of an entity without an id is uuid5(NAMESPACE, project_id/type/submitter_id), reloading is idempotent."""
+
+SYSTEM_PROPERTIES = ('type', 'id')
+"""Submission fields that are not node properties."""
+
+
+def iter_links(schema, entity_type):
+    """Yield (link, required) of entity_type, including links in (nested) subgroups."""
+
+    def _walk(links_, required):
+        for link in links_:
+            if 'subgroup' in link:
+                yield from _walk(link['subgroup'], required and link.get('required', False))
+            elif 'target_type' in link:
+                yield link, required and link.get('required', False)
+
+    yield from _walk(schema[entity_type].get('links', []), True)
+
+
+def links_by_name(schema, entity_type):
+    """Return {link name: (target_type, required)} of entity_type."""
+    return {link['name']: (link['target_type'], required) for link, required in iter_links(schema, entity_type)}
+
+
+class NodeIds:
+    """Resolve (type, submitter_id) to node_id, entities loaded in this run first, then the project's rows."""
+
+    def __init__(self, cur, project_id, project_node_id, node_table_by_label):
+        self.cur = cur
+        self.project_id = project_id
+        self.project_node_id = project_node_id
+        self.node_table_by_label = node_table_by_label
+        self.ids = defaultdict(dict)
+        self.loaded = set()
+        self.in_database = defaultdict(set)
+        self.existing = defaultdict(int)
+
+    def _load(self, entity_type):
+        """Once per type, read the submitter_id and node_id of the project's rows, e.g. submitted with sheepdog."""
+        if entity_type in self.loaded or self.cur is None:
+            return
+        self.loaded.add(entity_type)
+        self.cur.execute(
+            SQL("select _props->>'submitter_id', node_id from {} where _props->>'project_id' = %s;").format(
+                Identifier(self.node_table_by_label[entity_type])),
+            (self.project_id,)
+        )
+        ids = self.ids[entity_type]
+        for submitter_id, node_id in self.cur.fetchall():
+            ids.setdefault(submitter_id, node_id)
+            self.in_database[entity_type].add(submitter_id)
+
+    def node_id(self, entity_type, entity):
+        """Return the id of an entity read from a file, the id of the project's row with its submitter_id if there
+        is one, so the row is skipped instead of duplicated."""
+        self._load(entity_type)
+        ids = self.ids[entity_type]
+        node_id = ids.get(entity['submitter_id'])
+        if entity['submitter_id'] in self.in_database[entity_type]:
+            self.existing[entity_type] += 1
+        if not node_id:
+            node_id = entity.get('id') or str(uuid.uuid5(NAMESPACE, f"{self.project_id}/{entity_type}/"
+                                                                      f"{entity['submitter_id']}"))
+            ids[entity['submitter_id']] = node_id
+        return node_id
+
+    def resolve(self, target_type, link):
+        """Return the node_id of a link value e.g. {'submitter_id': ...}, None if it is not found."""
+        if 'id' in link:
+            return link['id']
+        if target_type == 'project':
+            return self.project_node_id
+        self._load(target_type)
+        return self.ids[target_type].get(link.get('submitter_id'))
+
+
+def to_record(entity, entity_type, links, node_ids, unresolved, deferred):
+    """Convert a submission entity to the PFB shaped record RecordConverter reads.
+
+    Links to the same type may point further on in the file, they are appended to deferred as (src_id, link).
+    """
+    node_id = node_ids.node_id(entity_type, entity)
+    relations = []
+    properties = {}
+    for name, value in entity.items():
+        if name in links:
+            target_type = links[name][0]
+            for link in value if isinstance(value, list) else [value]:
+                if target_type == entity_type:
+                    deferred.append((node_id, link))
+                    continue
+                dst_id = node_ids.resolve(target_type, link)
+                if dst_id:
+                    relations.append({"dst_id": dst_id, "dst_name": target_type})
+                else:
+                    unresolved[entity_type] += 1
+        elif name not in SYSTEM_PROPERTIES:
+            properties[name] = value
+    return {"id": node_id, "name": entity_type, "object": properties, "relations": relations}
+
+
+def load_direct(conn, schema, ddt, entity_paths, project_id, project_node_id, reader, dry_run=False):
+    """Bulk write entity files into the node_ and edge_ tables, a transaction per type, in the order given.
+
+    Return {type: records read} and {type: links that did not resolve}.
+    """
+    node_table_by_label = ddt.get_node_table_by_label()
+    converter = RecordConverter({label: {} for label in node_table_by_label}, ddt.get_edge_table_by_labels(),
+                                project_id)
+    cur = conn.cursor()
+    writer = CopyWriter(cur, dry_run)
+    node_ids = NodeIds(None if dry_run else cur, project_id, project_node_id, node_table_by_label)
+    counts = defaultdict(int)
+    unresolved = defaultdict(int)
+    for entity_type, path in entity_paths:
+        start = time.monotonic()
+        links = links_by_name(schema, entity_type)
+        node_table = node_table_by_label[entity_type]
+        edge_count = 0
+        deferred = []
+        converter.start_batch()
+        entities = iter(reader(path))
+        while True:
+            chunk = list(itertools.islice(entities, writer.buffer_size))
+            if not chunk:
+                break
+            edges = []
+            for entity in chunk:
+                record = to_record(entity, entity_type, links, node_ids, unresolved, deferred)
+                writer.write(node_table, converter.to_node(record))
+                edges.extend(converter.to_edges(record))
+            # the vertices are written before the edges that reference them
+            writer.flush()
+            for edge_table, edge in edges:
+                writer.write(edge_table, edge)
+            counts[entity_type] += len(chunk)
+            edge_count += len(edges)
+        writer.flush()
+        for src_id, link in deferred:
+            dst_id = node_ids.resolve(entity_type, link)
+            if not dst_id:
+                unresolved[entity_type] += 1
+                continue
+            for edge_table, edge in converter.to_edges({"id": src_id, "name": entity_type,
+                                                        "relations": [{"dst_id": dst_id, "dst_name": entity_type}]}):
+                writer.write(edge_table, edge)
+                edge_count += 1
+        writer.flush()
+        if not dry_run:
+            conn.commit()
+        elapsed = time.monotonic() - start
+        print(f"{entity_type} records {counts[entity_type]} existing {node_ids.existing[entity_type]} "
+              f"edges {edge_count} unresolved links "
+              f"{unresolved[entity_type]} seconds {elapsed:.2f} "
+              f"records/sec {counts[entity_type] / max(elapsed, 1e-6):.0f}")
+    writer.report()
+    cur.close()
+    return counts, unresolved
+
+
+def check_consistency(conn, schema, ddt, project_id, counts, unresolved):
+    """Compare rows with records read, find nodes missing a required link, return True if consistent."""
+    node_table_by_label = ddt.get_node_table_by_label()
+    edge_table_by_labels = ddt.get_edge_table_by_labels()
+    cur = conn.cursor()
+    consistent = True
+    for entity_type, expected in counts.items():
+        node_table = node_table_by_label[entity_type]
+        cur.execute(SQL("select count(*) from {} where _props->>'project_id' = %s;").format(Identifier(node_table)),
+                    (project_id,))
+        actual = cur.fetchone()[0]
+        problems = []
+        if actual < expected:
+            problems.append(f"missing {expected - actual}")
+        if unresolved[entity_type]:
+            problems.append(f"unresolved links {unresolved[entity_type]}")
+        for name, (target_type, required) in links_by_name(schema, entity_type).items():
+            if not required:
+                continue
+            cur.execute(
+                SQL("select count(*) from {} n where n._props->>'project_id' = %s "
+                    "and not exists (select 1 from {} e where e.src_id = n.node_id);").format(
+                    Identifier(node_table), Identifier(edge_table_by_labels[(entity_type, target_type)])),
+                (project_id,)
+            )
+            orphans = cur.fetchone()[0]
+            if orphans:
+                problems.append(f"without required {name} {orphans}")
+        consistent = consistent and not problems
+        print(f"check {entity_type} read {expected} in database {actual} {', '.join(problems) or 'ok'}")
+    cur.close()
+    return consistent
@@ -1,14 +1,15 @@
 import asyncio
 import base64
+import json
 import os.path
-import shutil
+import random
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, List
 
-import aiofiles
 import aiohttp
-from tempfile import TemporaryDirectory
 import sys
 from urllib.parse import urlparse
 import hashlib
@@ -37,54 +38,205 @@ def parts_generator(size, start=0, part_size=10 * 1024 ** 2):
     yield start, size
 
 
-async def async_download(url, headers, save_path):
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url) as request:
-            _logger(__name__).debug(('get', url, request))
-            file = await aiofiles.open(save_path, 'wb')
-            await file.write(await request.content.read())
-            _logger(__name__).debug(('download', threading.get_ident(), save_path))
+CHUNK_SIZE = 1024 ** 2
+"""Bytes read from the response and written to the file at a time."""
 
+MAX_PARTS_IN_FLIGHT = 8
+"""Default number of parts of a file downloading at the same time."""
 
-class Wrapped(object):
-    """Wrap the read() method and calculate MD5"""
-    def __init__(self, file_, md5_hash):
-        self._file = file_
-        self._md5_hash = md5_hash
+MAX_TOTAL_PARTS_IN_FLIGHT = 32
+"""Default number of parts downloading at the same time, over all files."""
 
-    def read(self, size):
-        buffer = self._file.read(size)
-        self._md5_hash.update(buffer)
-        return buffer
+LIMIT_PER_HOST = 16
+"""Default number of pooled connections per host."""
 
-    def __getattr__(self, attr):
-        return getattr(self._file, attr)
+MIN_PART_SIZE = 8 * 1024 ** 2
+MAX_PART_SIZE = 256 * 1024 ** 2
+TARGET_PART_SECONDS = 10
+"""Parts are sized to take about this long at the measured throughput."""
 
+RETRIES = 5
+BACKOFF = 1
+"""Seconds before the first retry of a part, doubled for each retry after."""
 
-async def process(url, size, expected_md5):
-    _logger(__name__).debug(('process', url))
-    filename = os.path.basename(urlparse(url).path)
-    tmp_dir = TemporaryDirectory(prefix=filename, dir=os.path.abspath('.'))
-    # size = await get_content_length(url)
-    tasks = []
-    file_parts = []
-    for number, sizes in enumerate(parts_generator(size)):
-        part_file_name = os.path.join(tmp_dir.name, f'{filename}.part{number}')
-        file_parts.append(part_file_name)
-        tasks.append(async_download(url, {'Range': f'bytes={sizes[0]}-{sizes[1]}'}, part_file_name))
-    await asyncio.gather(*tasks)
-    with open(filename, 'wb') as wfd:
-        md5_hash = hashlib.md5()
-        for f in file_parts:
-            with open(f, 'rb') as fd:
-                wrapped_fd = Wrapped(fd, md5_hash)
-                shutil.copyfileobj(wrapped_fd, wfd)
-        actual_md5 = md5_hash.hexdigest()
-        # compare calculated md5 vs expected
-        assert expected_md5 == actual_md5, f"Actual md5 {actual_md5} does not match expected {expected_md5}"
-        base64_md5 = base64.b64encode(bytes.fromhex(actual_md5))
-        _logger(__name__).debug(('md5', threading.get_ident(), filename, actual_md5, base64_md5))
-    return True
+
+class Throughput(object):
+    """Exponentially weighted moving average of the bytes/sec of a single part download."""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.bytes_per_second = None
+
+    def update(self, size, seconds):
+        if seconds <= 0:
+            return
+        rate = size / seconds
+        if self.bytes_per_second is None:
+            self.bytes_per_second = rate
+        else:
+            self.bytes_per_second = self.alpha * rate + (1 - self.alpha) * self.bytes_per_second
+
+
+class ChecksumError(Exception):
+    """Downloaded bytes do not match the expected checksum."""
+    pass
+
+
+class ShortReadError(Exception):
+    """The response ended before the end of the requested range, the part is retried."""
+    pass
+
+
+class PartPlanner(object):
+    """Hands out the byte ranges of a file, or only of its missing ranges.
+
+    Parts are small enough to keep max_parts_in_flight busy and, once a throughput is measured,
+    to finish in about TARGET_PART_SECONDS. A fixed part_size is used as is, e.g. to line parts up
+    with known per part checksums.
+    """
+
+    def __init__(self, size, throughput, max_parts_in_flight, part_size=None, ranges=None):
+        self.size = size
+        self.throughput = throughput
+        self.max_parts_in_flight = max_parts_in_flight
+        self.fixed_part_size = part_size
+        self.ranges = list(ranges) if ranges is not None else [(0, size)]
+
+    def part_size(self):
+        if self.fixed_part_size:
+            return self.fixed_part_size
+        part_size = -(-self.size // self.max_parts_in_flight)
+        if self.throughput.bytes_per_second:
+            part_size = min(part_size, int(self.throughput.bytes_per_second * TARGET_PART_SECONDS))
+        return max(MIN_PART_SIZE, min(MAX_PART_SIZE, part_size))
+
+    def next_range(self):
+        """Return the next (start, end) range, None when everything is handed out."""
+        while self.ranges and self.ranges[0][0] >= self.ranges[0][1]:
+            self.ranges.pop(0)
+        if not self.ranges:
+            return None
+        start, end = self.ranges[0]
+        part_end = min(end, start + self.part_size())
+        self.ranges[0] = (part_end, end)
+        return start, part_end
+
+
+class PartManifest(object):
+    """Sidecar file recording the ranges of a download that are on disk, so a rerun fetches only the rest."""
+
+    def __init__(self, path, size, md5):
+        self.path = path
+        self.size = size
+        self.md5 = md5
+        self.completed = []
+        if os.path.isfile(path):
+            with open(path) as fp:
+                manifest = json.load(fp)
+            if manifest['size'] == size and manifest['md5'] == md5:
+                self.completed = [tuple(part) for part in manifest['completed']]
+
+    def missing(self):
+        """Return the ranges not on disk."""
+        ranges = []
+        start = 0
+        for part_start, part_end, _ in sorted(self.completed):
+            if part_start > start:
+                ranges.append((start, part_start))
+            start = max(start, part_end)
+        if start < self.size or self.size == 0:
+            ranges.append((start, self.size))
+        return ranges
+
+    def add(self, start, end, md5=None):
+        """Record [start, end) as on disk, call after the data is synced."""
+        self.completed.append((start, end, md5))
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump({'size': self.size, 'md5': self.md5, 'completed': self.completed}, fp)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.unlink(self.path)
+
+
+class StreamingMD5(object):
+    """MD5 of a file whose parts complete out of order.
+
+    Completed ranges are hashed from the file (the page cache) as soon as they are contiguous with
+    everything hashed before, so the digest is ready when the last part lands.
+    """
+
+    def __init__(self, fd, size, executor):
+        self.fd = fd
+        self.size = size
+        self.executor = executor
+        self.md5_hash = hashlib.md5()
+        self.offset = 0
+        self.completed = {}
+        self.lock = asyncio.Lock()
+
+    def _update(self, start, end, chunk_size=CHUNK_SIZE):
+        while start < end:
+            buffer = os.pread(self.fd, min(chunk_size, end - start), start)
+            self.md5_hash.update(buffer)
+            start += len(buffer)
+
+    async def complete(self, start, end):
+        """Record that [start, end) is on disk, hash what is now contiguous."""
+        self.completed[start] = end
+        async with self.lock:
+            while self.offset in self.completed:
+                end = self.completed.pop(self.offset)
+                await asyncio.get_running_loop().run_in_executor(self.executor, self._update, self.offset, end)
+                self.offset = end
+
+    def hexdigest(self):
+        assert self.offset == self.size, f"Hashed {self.offset} of {self.size} bytes"
+        return self.md5_hash.hexdigest()
+
+
+def _write(fd, chunk, offset, part_hash):
+    """Write chunk at offset, update the part's hash."""
+    os.pwrite(fd, chunk, offset)
+    if part_hash:
+        part_hash.update(chunk)
+
+
+async def async_download(session, url, start, end, fd, throughput, executor=None, part_hash=None,
+                         chunk_size=CHUNK_SIZE):
+    """Stream bytes [start, end) of url into the open file fd, at the same offset."""
+    # http ranges are inclusive
+    started = time.monotonic()
+    async with session.get(url, headers={'Range': f'bytes={start}-{end - 1}'}) as request:
+        _logger(__name__).debug(('get', url, start, end, request.status))
+        request.raise_for_status()
+        loop = asyncio.get_running_loop()
+        offset = start
+        async for chunk in request.content.iter_chunked(chunk_size):
+            await loop.run_in_executor(executor, _write, fd, chunk, offset, part_hash)
+            offset += len(chunk)
+        if offset != end:
+            raise ShortReadError(f"Expected {end - start} bytes, got {offset - start} for range {start}-{end}")
+    throughput.update(end - start, time.monotonic() - started)
+    _logger(__name__).debug(('download', threading.get_ident(), start, end))
+
+
+def file_md5(fd, size, chunk_size=CHUNK_SIZE):
+    """Calculate the MD5 of the open file fd."""
+    md5_hash = hashlib.md5()
+    offset = 0
+    while offset < size:
+        buffer = os.pread(fd, min(chunk_size, size - offset), offset)
+        md5_hash.update(buffer)
+        offset += len(buffer)
+    return md5_hash.hexdigest()
+
+
+def multipart_etag(part_md5s):
+    """Return the ETag S3 assigns to an object uploaded in parts with these MD5s."""
+    return hashlib.md5(b''.join(bytes.fromhex(md5) for md5 in part_md5s)).hexdigest() + f"-{len(part_md5s)}"
 
 
 @dataclass
@@ -96,22 +248,194 @@ class DownloadURL(object):
     """Needed for integrity check."""
     size: int
     """Needed for multi part download."""
+    part_size: int = None
+    """Optional, download in parts of this size, e.g. the part size of the S3 multipart upload."""
+    part_md5s: List[str] = None
+    """Optional, MD5 of each part_size part, a mismatched part is fetched again."""
+    etag: str = None
+    """Optional, S3 ETag, checked against the part MD5s if it is a multipart ETag."""
+    refresh_url: Callable[[], str] = None
+    """Optional, returns a new signed url when the current one expires."""
+    file_name: str = None
+    """Optional, output path, defaults to the last segment of the url path."""
+    object_id: str = None
+    """Optional, GUID reported in the result."""
+
+
+@dataclass
+class DownloadResult(object):
+    """Outcome of a file download."""
+    download_url: DownloadURL
+    seconds: float
+    error: str = None
+    """None if the file was downloaded and verified."""
+
+    def to_dict(self):
+        return {
+            'object_id': self.download_url.object_id,
+            'file_name': self.download_url.file_name,
+            'size': self.download_url.size,
+            'status': 'error' if self.error else 'ok',
+            'seconds': round(self.seconds, 3),
+            'error': self.error,
+        }
 
 
-async def _download(urls: List[DownloadURL]):
-    """Download urls."""
-    results = await asyncio.gather(*[process(url.url, url.size, url.md5) for url in urls])
+async def process(session, semaphore, throughput, executor, download_url: DownloadURL,
+                  max_parts_in_flight=MAX_PARTS_IN_FLIGHT, part_attempts=3, retries=RETRIES):
+    """Download url in parts, holding the shared semaphore for each attempt of a part in flight.
+
+    Failed parts are retried with exponential backoff, an expired signed url is refreshed. Completed parts
+    are recorded in a sidecar manifest, so after a failure a rerun only fetches the missing ranges.
+    """
+    size, expected_md5 = download_url.size, download_url.md5
+    _logger(__name__).debug(('process', download_url.url))
+    filename = download_url.file_name or os.path.basename(urlparse(download_url.url).path)
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # per part hashes are needed to check them individually or to rebuild a multipart etag
+    hash_parts = download_url.part_size and (download_url.part_md5s or
+                                             (download_url.etag and '-' in download_url.etag))
+    manifest = PartManifest(f"{filename}.parts", size, expected_md5)
+    part_md5s = {start // download_url.part_size: md5 for start, _, md5 in manifest.completed} if hash_parts else {}
+    url_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    # size = await get_content_length(url)
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        # preallocate, every part is written in place at its offset
+        os.ftruncate(fd, size)
+        planner = PartPlanner(size, throughput, max_parts_in_flight, download_url.part_size, manifest.missing())
+        streaming_md5 = StreamingMD5(fd, size, executor)
+        # parts already on disk are hashed while the missing ones download
+        resumed = [asyncio.ensure_future(streaming_md5.complete(start, end)) for start, end, _ in manifest.completed]
+
+        async def _refresh_url(expired_url):
+            async with url_lock:
+                if download_url.url == expired_url:
+                    download_url.url = await loop.run_in_executor(None, download_url.refresh_url)
+                    _logger(__name__).info(f"{filename} refreshed signed url")
+
+        async def _download_part(start, end):
+            checksum_attempts = 0
+            attempt = 0
+            while True:
+                part_hash = hashlib.md5() if hash_parts else None
+                url = download_url.url
+                try:
+                    # the shared slot is held per attempt, a part backing off does not starve the other files
+                    async with semaphore:
+                        await async_download(session, url, start, end, fd, throughput, executor, part_hash)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ShortReadError) as e:
+                    attempt += 1
+                    if attempt > retries:
+                        raise
+                    if isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status not in (408, 429):
+                        # an expired signed url is the only client error worth retrying
+                        if e.status not in (400, 401, 403) or not download_url.refresh_url:
+                            raise
+                        await _refresh_url(url)
+                    delay = BACKOFF * 2 ** (attempt - 1) * (1 + random.random())
+                    _logger(__name__).warning(f"{filename} range {start}-{end} {type(e).__name__} "
+                                              f"{getattr(e, 'status', '')}, retry {attempt} in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                if not part_hash:
+                    return None
+                part_number = start // download_url.part_size
+                part_md5s[part_number] = part_hash.hexdigest()
+                if not download_url.part_md5s or download_url.part_md5s[part_number] == part_md5s[part_number]:
+                    return part_md5s[part_number]
+                checksum_attempts += 1
+                _logger(__name__).warning(f"{filename} part {part_number} md5 mismatch, attempt {checksum_attempts}")
+                if checksum_attempts == part_attempts:
+                    raise ChecksumError(f"{filename} part {part_number} md5 {part_md5s[part_number]} does not "
+                                        f"match expected {download_url.part_md5s[part_number]}")
+
+        async def _worker():
+            while True:
+                part = planner.next_range()
+                if not part:
+                    return
+                part_md5 = await _download_part(*part)
+                await loop.run_in_executor(executor, os.fdatasync, fd)
+                manifest.add(part[0], part[1], part_md5)
+                await streaming_md5.complete(*part)
+
+        workers = [
+            asyncio.ensure_future(_worker()) for _ in range(min(max_parts_in_flight, max(1, -(-size // MIN_PART_SIZE))))
+        ]
+        try:
+            await asyncio.gather(*workers, *resumed)
+        except Exception:
+            # stop the other parts before the file is closed
+            for worker in workers + resumed:
+                worker.cancel()
+            await asyncio.gather(*workers, *resumed, return_exceptions=True)
+            raise
+        actual_md5 = streaming_md5.hexdigest()
+    finally:
+        os.close(fd)
+    try:
+        # compare calculated md5 vs expected
+        if expected_md5 != actual_md5:
+            raise ChecksumError(f"Actual md5 {actual_md5} does not match expected {expected_md5}")
+        if hash_parts and download_url.etag and '-' in download_url.etag:
+            actual_etag = multipart_etag([part_md5s[i] for i in sorted(part_md5s)])
+            if actual_etag != download_url.etag.strip('"'):
+                raise ChecksumError(f"Actual etag {actual_etag} does not match expected {download_url.etag}")
+    finally:
+        # complete, or corrupt: either way there is nothing to resume
+        manifest.remove()
+    base64_md5 = base64.b64encode(bytes.fromhex(actual_md5))
+    _logger(__name__).debug(('md5', threading.get_ident(), filename, actual_md5, base64_md5))
+    return True
+
+
+async def _download(urls: List[DownloadURL], max_parts_in_flight=MAX_PARTS_IN_FLIGHT,
+                    max_total_parts_in_flight=MAX_TOTAL_PARTS_IN_FLIGHT, limit_per_host=LIMIT_PER_HOST,
+                    callback=None):
+    """Download urls over one pooled session, call callback with each DownloadResult as it completes."""
+    semaphore = asyncio.Semaphore(max_total_parts_in_flight)
+    throughput = Throughput()
+    connector = aiohttp.TCPConnector(limit=max_total_parts_in_flight, limit_per_host=limit_per_host)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+    async def _process(session, executor, url):
+        started = time.monotonic()
+        error = None
+        try:
+            await process(session, semaphore, throughput, executor, url, max_parts_in_flight)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            _logger(__name__).error(f"{url.file_name or url.url} {error}")
+        result = DownloadResult(download_url=url, seconds=time.monotonic() - started, error=error)
+        if callback:
+            callback(result)
+        return result
+
+    # writes and hashes run in this pool, hashlib releases the GIL for large buffers
+    with ThreadPoolExecutor(max_workers=max_total_parts_in_flight) as executor:
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(*[_process(session, executor, url) for url in urls])
     return results
 
 
-def download(urls: List[DownloadURL]):
-    """Setup async loop and download urls."""
-    import time
+def download(urls: List[DownloadURL], max_parts_in_flight=MAX_PARTS_IN_FLIGHT,
+             max_total_parts_in_flight=MAX_TOTAL_PARTS_IN_FLIGHT, limit_per_host=LIMIT_PER_HOST, callback=None):
+    """Setup async loop and download urls, return a DownloadResult per url."""
     start_code = time.monotonic()
     _logger(__name__).debug('START')
     loop = asyncio.get_event_loop()
-    results = loop.run_until_complete(_download(urls))
-    _logger(__name__).info(f'{time.monotonic() - start_code} seconds {results}')
+    results = loop.run_until_complete(
+        _download(urls, max_parts_in_flight, max_total_parts_in_flight, limit_per_host, callback)
+    )
+    elapsed = time.monotonic() - start_code
+    downloaded = sum(result.download_url.size for result in results if not result.error)
+    errors = sum(1 for result in results if result.error)
+    _logger(__name__).info(f'{elapsed:.2f} seconds files {len(results)} errors {errors} '
+                           f'MB/sec {downloaded / max(elapsed, 1e-6) / 1024 ** 2:.1f}')
+    return results
 
 
 # async def main():
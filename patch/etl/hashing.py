@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Tuple
+
+BUFFER_SIZE = 8 * 1024 ** 2
+"""Bytes read per system call."""
+
+CACHE_PATH = os.environ.get('HASH_CACHE_PATH', os.path.expanduser('~/.cache/gen3-etl/hashes.sqlite'))
+"""Default location of the md5 cache, set HASH_CACHE_PATH to override."""
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def md5_file(path, buffer_size=BUFFER_SIZE):
+    """Return the md5 hex digest of the file, read into one reused buffer."""
+    md5_hash = hashlib.md5()
+    with open(path, 'rb', buffering=0) as fp:
+        buffer = bytearray(max(1, min(buffer_size, os.fstat(fp.fileno()).st_size)))
+        view = memoryview(buffer)
+        while True:
+            length = fp.readinto(buffer)
+            if not length:
+                break
+            md5_hash.update(view[:length])
+    return md5_hash.hexdigest()
+
+
+class HashCache(object):
+    """Persistent md5 cache, an entry is only used while the file's inode, mtime and size are unchanged."""
+
+    def __init__(self, path=CACHE_PATH):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('pragma journal_mode=wal')
+        self.connection.execute(
+            'create table if not exists hashes '
+            '(path text primary key, inode integer, mtime_ns integer, size integer, md5 text)'
+        )
+
+    def get(self, path, stat):
+        """Return the cached md5, None if missing or stale."""
+        row = self.connection.execute('select inode, mtime_ns, size, md5 from hashes where path = ?',
+                                      (path,)).fetchone()
+        if row and row[:3] == (stat.st_ino, stat.st_mtime_ns, stat.st_size):
+            return row[3]
+        return None
+
+    def put(self, entries):
+        """Save (path, stat, md5) entries."""
+        with self.connection:
+            self.connection.executemany(
+                'insert or replace into hashes values (?, ?, ?, ?, ?)',
+                [(path, stat.st_ino, stat.st_mtime_ns, stat.st_size, md5) for path, stat, md5 in entries]
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+def file_attributes_many(paths: Iterable[str], workers=None, cache_path=CACHE_PATH) -> Dict[str, Tuple[str, int]]:
+    """Return {path: (md5, size)}, hashing files missing from the cache with a pool of processes.
+
+    cache_path None disables the cache.
+    """
+    stats = {path: os.stat(path) for path in paths}
+    if not stats:
+        return {}
+    cache = HashCache(cache_path) if cache_path else None
+    attributes = {}
+    misses = []
+    for path, stat in stats.items():
+        md5 = cache.get(os.path.abspath(path), stat) if cache else None
+        if md5:
+            attributes[path] = (md5, stat.st_size)
+        else:
+            misses.append(path)
+
+    workers = workers or os.cpu_count()
+    if len(misses) > 1 and workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            md5s = list(executor.map(md5_file, misses, chunksize=max(1, len(misses) // 64)))
+    else:
+        md5s = [md5_file(path) for path in misses]
+
+    for path, md5 in zip(misses, md5s):
+        attributes[path] = (md5, stats[path].st_size)
+    if cache:
+        cache.put([(os.path.abspath(path), stats[path], md5) for path, md5 in zip(misses, md5s)])
+        cache.close()
+    _logger(__name__).debug(f"files {len(stats)} cached {len(stats) - len(misses)} hashed {len(misses)}")
+    return attributes
+
+
+def file_attributes(file_name, cache_path=CACHE_PATH):
+    """Calculate the hash and size."""
+    return file_attributes_many([file_name], workers=1, cache_path=cache_path)[file_name]
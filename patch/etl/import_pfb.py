@@ -1,12 +1,19 @@
+import csv
+import io
 import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict, deque
 from datetime import datetime
 
+import click
 import psycopg2
 from psycopg2.sql import Identifier, SQL
 
-from fastavro import reader
+from fastavro import block_reader, reader
 from pfb.base import handle_schema_field_unicode, is_enum, decode_enum
-from pelican.dictionary import init_dictionary, DataDictionaryTraversal
+from dictionary import init_dictionary, DataDictionaryTraversal, RecordConverter
 
 
 def create_node_dict(node_id, node_name, values, edges):
@@ -120,118 +127,365 @@ def write_table(cur, table, node, dry_run=True):
         cur.execute(SQL(insert), values)
 
 
-def import_pfb_job(pfb_file, project_id, project_node_id, ddt, conn, dry_run, document_reference_object_ids):
-    """Import the PFB into the database."""
-    start_time = datetime.now()
-    print(start_time)
+class RowWriter:
+    """Write each vertex and edge with its own `insert ... on conflict do nothing`."""
+
+    def __init__(self, cur, dry_run=True):
+        self.cur = cur
+        self.dry_run = dry_run
+        self.row_counts = defaultdict(int)
+        self.elapsed = defaultdict(float)
+
+    def write(self, table, row):
+        """Write a single row."""
+        start = time.monotonic()
+        write_table(cur=self.cur, table=table, node=row, dry_run=self.dry_run)
+        self.elapsed[table] += time.monotonic() - start
+        self.row_counts[table] += 1
+
+    def flush(self):
+        """Nothing is buffered."""
+        pass
+
+    def report(self):
+        """Print rows/sec per table."""
+        for table in sorted(self.row_counts):
+            elapsed = self.elapsed[table]
+            rate = self.row_counts[table] / elapsed if elapsed else 0
+            print(f"{table} rows {self.row_counts[table]} seconds {elapsed:.2f} rows/sec {rate:.0f}")
+
+
+class CopyWriter(RowWriter):
+    """Buffer rows per table, stream them into postgres with `COPY FROM STDIN`.
+
+    Rows are copied into a session scoped staging table, then moved into the target with
+    `insert ... select ... on conflict do nothing`, so re-importing a PFB is still idempotent.
+    """
+
+    def __init__(self, cur, dry_run=True, buffer_size=10000):
+        super().__init__(cur, dry_run)
+        self.buffer_size = buffer_size
+        self.buffers = defaultdict(list)
+        self.staging_tables = {}
+
+    def write(self, table, row):
+        """Buffer a row, copy the table's buffer when it is full."""
+        buffer = self.buffers[table]
+        buffer.append(row)
+        if len(buffer) >= self.buffer_size:
+            self._copy(table)
+
+    def flush(self):
+        """Copy all buffered rows, call before commit."""
+        for table in list(self.buffers):
+            self._copy(table)
+
+    def _staging_table(self, table):
+        """Create (once per connection) a temporary table shaped like table."""
+        if table not in self.staging_tables:
+            staging_table = f"_stage_{len(self.staging_tables)}"
+            self.cur.execute(
+                SQL("create temp table if not exists {} (like {} including defaults);").format(
+                    Identifier(staging_table), Identifier(table))
+            )
+            self.staging_tables[table] = staging_table
+        return self.staging_tables[table]
+
+    def _copy(self, table):
+        """Copy the buffered rows of table."""
+        rows = self.buffers.pop(table, None)
+        if not rows:
+            return
+        start = time.monotonic()
+        columns = list(rows[0].keys())
+        if not self.dry_run:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerows([row[column] for column in columns] for row in rows)
+            buffer.seek(0)
+
+            staging_table = self._staging_table(table)
+            column_list = SQL(',').join(Identifier(column) for column in columns)
+            conflict = SQL('node_id') if 'node_id' in columns else SQL('src_id, dst_id')
+            self.cur.copy_expert(
+                SQL("copy {} ({}) from stdin with (format csv)").format(Identifier(staging_table), column_list),
+                buffer
+            )
+            self.cur.execute(
+                SQL("insert into {} ({}) select {} from {} on conflict({}) do nothing;").format(
+                    Identifier(table), column_list, column_list, Identifier(staging_table), conflict)
+            )
+            self.cur.execute(SQL("truncate {};").format(Identifier(staging_table)))
+        self.elapsed[table] += time.monotonic() - start
+        self.row_counts[table] += len(rows)
+
+
+def is_base64_by_label(writer_schema):
+    """Map node name -> field name -> is the field an enum (base64 encoded)."""
+    schema = []
+    for schema_field in writer_schema["fields"]:
+        if schema_field["name"] == "object":
+            it = iter(schema_field["type"])
+            # skip metadata
+            next(it)
+            for node in it:
+                schema.append(node)
+                for field in node["fields"]:
+                    handle_schema_field_unicode(field, encode=False)
+
+    _is_base64 = {}
+
+    for node in schema:
+        _is_base64[node["name"]] = fields = {}
+        for field in node["fields"]:
+            fields[field["name"]] = is_enum(field["type"])
+    return _is_base64
+
+
+def prepare_record(record, project_node_id, document_reference_object_ids):
+    """Link the record to the gen3 project and uploaded files, return None for records that are not imported."""
+    if record['name'] == 'Metadata':
+        return None
+    if record['name'] == 'ResearchStudy':
+        # link the ResearchStudy to the gen3 project
+        record['relations'] = [{"dst_id": project_node_id, "dst_name": "project"}]
+    if record['name'] == 'DocumentReference':
+        # link the ResearchStudy to the gen3 project
+        if record['id'] in document_reference_object_ids:
+            record['object']['object_id'] = document_reference_object_ids[record['id']]
+            # print(f"Set document_reference_object_ids {record['object']['object_id']}")
+    return record
+
+
+def write_record(writer, record, node_table_by_label, converter, vertices=True, edges=True):
+    """Convert the record, write its vertex and/or edges."""
+    if vertices:
+        writer.write(node_table_by_label[record['name']], converter.to_node(record))
+    if edges:
+        for edge_table, edge in converter.to_edges(record):
+            writer.write(edge_table, edge)
+
+
+def read_checkpoint(journal_path, pfb_file):
+    """Return the last checkpoint journaled for pfb_file, None if there is none."""
+    if not journal_path or not os.path.isfile(journal_path):
+        return None
+    checkpoint = None
+    with open(journal_path) as journal:
+        for line in journal:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry['pfb_file'] == os.path.abspath(pfb_file):
+                checkpoint = entry
+    if checkpoint:
+        assert checkpoint['pfb_size'] == os.path.getsize(pfb_file), \
+            f"{pfb_file} changed since checkpoint {checkpoint}, can not resume"
+    return checkpoint
+
+
+def write_checkpoint(journal, pfb_file, offset, record_count, complete=False):
+    """Append a checkpoint: the offset of the next avro block to read and the records committed before it."""
+    checkpoint = {
+        'pfb_file': os.path.abspath(pfb_file),
+        'pfb_size': os.path.getsize(pfb_file),
+        'offset': offset,
+        'record_count': record_count,
+        'complete': complete,
+        'timestamp': datetime.now().isoformat(),
+    }
+    journal.write(json.dumps(checkpoint))
+    journal.write('\n')
+    journal.flush()
+    os.fsync(journal.fileno())
 
-    with open(pfb_file, "rb") as schema_field:
-        avro_reader = reader(schema_field)
-        writer_schema = avro_reader.writer_schema
 
-        schema = []
-        for schema_field in writer_schema["fields"]:
-            if schema_field["name"] == "object":
-                it = iter(schema_field["type"])
-                # skip metadata
-                next(it)
-                for node in it:
-                    schema.append(node)
-                    for field in node["fields"]:
-                        handle_schema_field_unicode(field, encode=False)
+def import_pfb_job(pfb_file, project_id, project_node_id, ddt, conn, dry_run, document_reference_object_ids,
+                   bulk=False, journal_path=None, resume=False):
+    """Import the PFB into the database, with COPY if bulk, otherwise row by row.
 
-        _is_base64 = {}
+    Batches are committed on avro block boundaries; if journal_path is set each commit is journaled, and
+    resume seeks straight to the block after the last commit.
+    """
+    start_time = datetime.now()
+    print(start_time)
+
+    checkpoint = read_checkpoint(journal_path, pfb_file) if resume else None
+    if checkpoint and checkpoint['complete']:
+        print(f"{pfb_file} already imported {checkpoint}")
+        conn.close()
+        return
 
-        for node in schema:
-            _is_base64[node["name"]] = fields = {}
-            for field in node["fields"]:
-                fields[field["name"]] = is_enum(field["type"])
+    with open(pfb_file, "rb") as schema_field:
+        avro_reader = block_reader(schema_field)
+        _is_base64 = is_base64_by_label(avro_reader.writer_schema)
 
-        edge_table_by_labels = ddt.get_edge_table_by_labels()
+        node_table_by_label = ddt.get_node_table_by_label()
+        converter = RecordConverter(_is_base64, ddt.get_edge_table_by_labels(), project_id)
 
         insert_count = 0
         total_count = 0
+        if checkpoint:
+            # blocks are read lazily, so moving the file position skips everything already committed
+            schema_field.seek(checkpoint['offset'])
+            total_count = checkpoint['record_count']
+            print(f"Resuming {pfb_file} at offset {checkpoint['offset']} total_count {total_count}")
         batch_size = 10000
+        journal = open(journal_path, 'a') if journal_path else None
         cur = conn.cursor()
-        for record in avro_reader:
-            if record['name'] == 'Metadata':
-                continue
-            if record['name'] == 'ResearchStudy':
-                # link the ResearchStudy to the gen3 project
-                record['relations'] = [{"dst_id": project_node_id, "dst_name": "project"}]
-            if record['name'] == 'DocumentReference':
-                # link the ResearchStudy to the gen3 project
-                if record['id'] in document_reference_object_ids:
-                    record['object']['object_id'] = document_reference_object_ids[record['id']]
-                    # print(f"Set document_reference_object_ids {record['object']['object_id']}")
-
-            write_table(
-                cur=cur,
-                table=ddt.get_node_table_by_label()[record['name']],
-                node=convert_to_node(record, _is_base64, project_id),
-                dry_run=dry_run
-            )
-            edge_tuples = convert_to_edge(record, edge_table_by_labels)
-            if edge_tuples:
-                for edge_tuple in edge_tuples:
-                    edge_table = edge_tuple[0]
-                    edge = edge_tuple[1]
-                    write_table(
-                        cur=cur,
-                        table=edge_table,
-                        node=edge,
-                        dry_run=dry_run
-                    )
-            insert_count += 1
-            if insert_count == batch_size:
+        writer = CopyWriter(cur, dry_run, buffer_size=batch_size) if bulk else RowWriter(cur, dry_run)
+        offset = schema_field.tell()
+        for block in avro_reader:
+            for record in block:
+                if not prepare_record(record, project_node_id, document_reference_object_ids):
+                    continue
+                write_record(writer, record, node_table_by_label, converter)
+                insert_count += 1
+            offset = block.offset + block.size
+            if insert_count >= batch_size:
+                writer.flush()
                 conn.commit()
+                converter.start_batch()
                 total_count += insert_count
                 insert_count = 0
+                if journal:
+                    write_checkpoint(journal, pfb_file, offset, total_count)
                 print("total_count {} {} {}".format(total_count, record['name'], datetime.now()))
+        writer.flush()
         conn.commit()
         total_count += insert_count
+        if journal:
+            write_checkpoint(journal, pfb_file, offset, total_count, complete=True)
+            journal.close()
         time_elapsed = datetime.now() - start_time
         print("Elapsed time: {} total_count {}".format(time_elapsed, total_count))
+        writer.report()
         cur.close()
         conn.close()
     return
 
 
-if __name__ == "__main__":
+def partition_records(pfb_file, project_node_id, document_reference_object_ids, batch_size):
+    """Yield (label, records) partitions, each holding up to batch_size records of one node label."""
+    buffers = defaultdict(list)
+    with open(pfb_file, "rb") as fo:
+        for record in reader(fo):
+            record = prepare_record(record, project_node_id, document_reference_object_ids)
+            if not record:
+                continue
+            buffer = buffers[record['name']]
+            buffer.append(record)
+            if len(buffer) == batch_size:
+                yield record['name'], buffers.pop(record['name'])
+    for label, records in buffers.items():
+        yield label, records
 
-    # TODO - get this from the command line
-    dry_run = False
-    # TODO - get this from the command line
-    dictionary_url = 'https://aced-public.s3.us-west-2.amazonaws.com/aced.json'  # os.environ["DICTIONARY_URL"]
 
-    # TODO - get this from the command line
-    with open("Secrets/sheepdog_creds.json") as pelican_creds_file:
-        sheepdog_creds = json.load(pelican_creds_file)
+# per process state of a parallel import worker, see _init_worker
+_worker = {}
 
-    # DB_URL = "jdbc:postgresql://{}/{}".format(
-    #     sheepdog_creds["db_host"], sheepdog_creds["db_database"]
-    # )
-    DB_USER = sheepdog_creds["db_username"]
-    DB_PASS = sheepdog_creds["db_password"]
 
-    # TODO - get this from the command line
-    DB_NAME = 'metadata_db'
+def _init_worker(connection_kwargs, context):
+    """Open this worker's own database connection."""
+    conn = psycopg2.connect(**connection_kwargs)
+    cur = conn.cursor()
+    _worker.update(context)
+    _worker['converter'] = RecordConverter(context['is_base64'], context['edge_table_by_labels'],
+                                           context['project_id'])
+    _worker['conn'] = conn
+    _worker['cur'] = cur
+    if context['bulk']:
+        _worker['writer'] = CopyWriter(cur, context['dry_run'], buffer_size=context['batch_size'])
+    else:
+        _worker['writer'] = RowWriter(cur, context['dry_run'])
+
 
-    # TODO - get this from the command line
-    program_name = 'MyFirstProgram'
-    project_code = 'MyFirstProject'
+def _load_partition(phase, label, records):
+    """Write the vertices or the edges of a partition and commit, return (pid, phase, label, count)."""
+    writer = _worker['writer']
+    converter = _worker['converter']
+    converter.start_batch()
+    for record in records:
+        write_record(writer, record, _worker['node_table_by_label'], converter,
+                     vertices=phase == 'vertices', edges=phase == 'edges')
+    writer.flush()
+    _worker['conn'].commit()
+    return os.getpid(), phase, label, len(records)
 
-    # NEW_DB_NAME = input_data_json["db"]
 
-    conn = psycopg2.connect(
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS,
-        # TODO - get this from the command line
-        host='localhost',
-        # port=DATABASE_CONFIG.get('port'),
-    )
+def import_pfb_parallel_job(pfb_file, project_id, project_node_id, ddt, connection_kwargs, dry_run,
+                            document_reference_object_ids, bulk=False, workers=4, batch_size=10000):
+    """Import the PFB with a pool of worker processes, each with its own database connection.
 
+    The file is read twice: first all vertices are loaded and committed, then the edges that reference them.
+    """
+    start_time = datetime.now()
+    print(start_time)
+
+    with open(pfb_file, "rb") as fo:
+        _is_base64 = is_base64_by_label(reader(fo).writer_schema)
+
+    context = {
+        'node_table_by_label': dict(ddt.get_node_table_by_label()),
+        'edge_table_by_labels': dict(ddt.get_edge_table_by_labels()),
+        'is_base64': _is_base64,
+        'project_id': project_id,
+        'dry_run': dry_run,
+        'bulk': bulk,
+        'batch_size': batch_size,
+    }
+    vertex_counts = defaultdict(int)
+    worker_counts = defaultdict(int)
+
+    def collect(result):
+        pid, phase, label, count = result.get()
+        worker_counts[(pid, phase)] += count
+        if phase == 'vertices':
+            vertex_counts[label] += count
+        print(f"worker {pid} {phase} {label} {count} worker_total {worker_counts[(pid, phase)]} {datetime.now()}")
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(connection_kwargs, context)) as pool:
+        for phase in ('vertices', 'edges'):
+            # bound the partitions in flight, the reader is faster than the database
+            pending = deque()
+            for label, records in partition_records(pfb_file, project_node_id, document_reference_object_ids,
+                                                    batch_size):
+                pending.append(pool.apply_async(_load_partition, (phase, label, records)))
+                if len(pending) >= workers * 2:
+                    collect(pending.popleft())
+            while pending:
+                collect(pending.popleft())
+            print(f"Committed {phase} {datetime.now() - start_time}")
+
+    for (pid, phase), count in sorted(worker_counts.items()):
+        print(f"worker {pid} {phase} total {count}")
+
+    total_count = sum(vertex_counts.values())
+    time_elapsed = datetime.now() - start_time
+    print("Elapsed time: {} total_count {}".format(time_elapsed, total_count))
+    if not dry_run:
+        reconcile(connection_kwargs, project_id, context['node_table_by_label'], vertex_counts)
+
+
+def reconcile(connection_kwargs, project_id, node_table_by_label, vertex_counts):
+    """Compare the number of records read per label with the rows in the project."""
+    conn = psycopg2.connect(**connection_kwargs)
+    cur = conn.cursor()
+    for label, expected in sorted(vertex_counts.items()):
+        cur.execute(
+            SQL("select count(*) from {} where _props->>'project_id' = %s;").format(
+                Identifier(node_table_by_label[label])),
+            (project_id,)
+        )
+        actual = cur.fetchone()[0]
+        status = 'ok' if actual >= expected else 'MISSING'
+        print(f"reconcile {label} read {expected} in database {actual} {status}")
+    cur.close()
+    conn.close()
+
+
+def get_project_node_id(conn, program_name, project):
+    """Return the node_id of the project, assert the program and project exist."""
     cur = conn.cursor()
     cur.execute("select node_id, _props from \"node_program\";")
     programs = cur.fetchall()
@@ -241,25 +495,99 @@ if __name__ == "__main__":
     cur.execute("select node_id, _props from \"node_project\";")
     projects = cur.fetchall()
     projects = [{'node_id': p[0], '_props': p[1]} for p in projects]
-    project_node_id = next(iter([p['node_id'] for p in projects if p['_props']['code'] == project_code]), None)
-    assert project_node_id, f"{project_code} not found in node_project"
-    project_id = f"{program_name}-{project_code}"
+    project_node_id = next(iter([p['node_id'] for p in projects if p['_props']['code'] == project]), None)
+    assert project_node_id, f"{project} not found in node_project"
+    cur.close()
+    return project_node_id
+
+
+def connection_kwargs_from_creds(sheepdog_creds, db_name, db_host):
+    """Return psycopg2.connect kwargs, user and password from the sheepdog credentials file."""
+    with open(sheepdog_creds) as pelican_creds_file:
+        sheepdog_creds = json.load(pelican_creds_file)
+
+    # DB_URL = "jdbc:postgresql://{}/{}".format(
+    #     sheepdog_creds["db_host"], sheepdog_creds["db_database"]
+    # )
+    DB_USER = sheepdog_creds["db_username"]
+    DB_PASS = sheepdog_creds["db_password"]
+
+    return dict(
+        database=db_name,
+        user=DB_USER,
+        password=DB_PASS,
+        host=db_host,
+        # port=DATABASE_CONFIG.get('port'),
+    )
+
+
+@click.command()
+@click.option('--pfb_file', default='output/research_study_Alzheimers.pfb', show_default=True,
+              help='Path to pfb file')
+@click.option('--program', default='MyFirstProgram', show_default=True,
+              help='Gen3 program')
+@click.option('--project', default='MyFirstProject', show_default=True,
+              help='Gen3 project')
+@click.option('--dictionary_url', default='https://aced-public.s3.us-west-2.amazonaws.com/aced.json',
+              show_default=True, help='Data dictionary url')
+@click.option('--sheepdog_creds', default='Secrets/sheepdog_creds.json', show_default=True,
+              help='Database credentials')
+@click.option('--db_name', default='metadata_db', show_default=True,
+              help='Database name')
+@click.option('--db_host', default='localhost', show_default=True,
+              help='Database host')
+@click.option('--object_ids', default='file-object_ids.ndjson', show_default=True,
+              help='Object ids created by `file upload-pfb`')
+@click.option('--bulk', is_flag=True, default=False, show_default=True,
+              help='Stream rows with COPY instead of one insert per row')
+@click.option('--workers', default=1, show_default=True,
+              help='Number of worker processes, each with its own database connection')
+@click.option('--journal', default=None, show_default=True,
+              help='Checkpoint journal path, defaults to <pfb_file>.checkpoint')
+@click.option('--resume', is_flag=True, default=False, show_default=True,
+              help='Continue after the last checkpoint in the journal')
+@click.option('--dry_run', is_flag=True, default=False, show_default=True,
+              help='Read and convert, do not write to the database')
+def cli(pfb_file, program, project, dictionary_url, sheepdog_creds, db_name, db_host, object_ids, bulk, workers,
+        journal, resume, dry_run):
+    """Import a PFB directly into the metadata database."""
+    assert not (resume and workers > 1), "--resume is not supported with --workers"
+    if not journal:
+        journal = f"{pfb_file}.checkpoint"
+
+    connection_kwargs = connection_kwargs_from_creds(sheepdog_creds, db_name, db_host)
+    conn = psycopg2.connect(**connection_kwargs)
+
+    project_node_id = get_project_node_id(conn, program, project)
+    project_id = f"{program}-{project}"
 
-    # TODO - get this from the command line
-    pfb_file = 'output/research_study_Alzheimers.pfb'
     print(f"Importing {pfb_file} into {project_id} project node {project_node_id}")
 
     dictionary, model = init_dictionary(url=dictionary_url)
     ddt = DataDictionaryTraversal(model)
 
-    # TODO - get this from the command line
     # get the object ids created by file upload-pfb
     document_reference_object_ids = {}
-    with open('file-object_ids.ndjson') as f:
+    with open(object_ids) as f:
         for line in f.readlines():
             document_reference_object_id = json.loads(line)
             document_reference_object_ids[document_reference_object_id['id']] = document_reference_object_id['object_id']
 
+    if workers > 1:
+        conn.close()
+        import_pfb_parallel_job(
+            pfb_file=pfb_file,
+            project_id=project_id,
+            project_node_id=project_node_id,
+            ddt=ddt,
+            connection_kwargs=connection_kwargs,
+            dry_run=dry_run,
+            document_reference_object_ids=document_reference_object_ids,
+            bulk=bulk,
+            workers=workers
+        )
+        return
+
     import_pfb_job(
         pfb_file=pfb_file,
         project_id=project_id,
@@ -267,5 +595,12 @@ if __name__ == "__main__":
         ddt=ddt,
         conn=conn,
         dry_run=dry_run,
-        document_reference_object_ids=document_reference_object_ids
+        document_reference_object_ids=document_reference_object_ids,
+        bulk=bulk,
+        journal_path=None if dry_run else journal,
+        resume=resume
     )
+
+
+if __name__ == "__main__":
+    cli()
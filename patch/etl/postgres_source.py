@@ -0,0 +1,178 @@
+import logging
+import time
+from collections import defaultdict
+
+from psycopg2.sql import Identifier, Literal, SQL
+
+from denormalize import parse_query
+from direct_load import iter_links
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def link_join(schema, ddt, label, link_name):
+    """Return (edge table, column of label's node_id, column of the linked node_id, linked label).
+
+    link_name is a link of label, or the backref of a link to label.
+    """
+    edge_table_by_labels = ddt.get_edge_table_by_labels()
+    for link, _ in iter_links(schema, label):
+        if link['name'] == link_name:
+            return edge_table_by_labels[(label, link['target_type'])], 'src_id', 'dst_id', link['target_type']
+    for src_label in schema:
+        if not isinstance(schema[src_label], dict) or 'links' not in schema[src_label]:
+            continue
+        for link, _ in iter_links(schema, src_label):
+            if link.get('backref') == link_name and link['target_type'] == label:
+                return edge_table_by_labels[(src_label, label)], 'dst_id', 'src_id', src_label
+    raise ValueError(f"{label} has no link or backref {link_name}")
+
+
+def query_labels(schema, ddt, graphql):
+    """Return the node labels a query reads, the root first."""
+    root = parse_query(graphql)
+    labels = [root.name]
+
+    def _walk(label, fields):
+        for f in fields:
+            if f.fields is not None:
+                child_label = link_join(schema, ddt, label, f.name)[3]
+                if child_label not in labels:
+                    labels.append(child_label)
+                _walk(child_label, f.fields)
+
+    _walk(root.name, root.fields)
+    return labels
+
+
+def project_marks(conn, node_tables):
+    """Return {project_id: mark} over node_tables, a mark changes when a node of the project is created, updated
+    or deleted: the latest created (or sheepdog's updated_datetime) and the number of nodes."""
+    latest = {}
+    counts = defaultdict(int)
+    cur = conn.cursor()
+    for node_table in node_tables:
+        cur.execute(SQL(
+            "select _props->>'project_id', max(greatest(created, (_props->>'updated_datetime')::timestamptz)), "
+            "count(*) from {} group by 1;").format(Identifier(node_table)))
+        for project_id, updated, count in cur.fetchall():
+            if project_id is None:
+                continue
+            latest[project_id] = max(latest.get(project_id, updated), updated)
+            counts[project_id] += count
+    cur.close()
+    conn.commit()
+    return {project_id: f"{latest[project_id].isoformat()} {counts[project_id]}" for project_id in latest}
+
+
+def _columns(fields):
+    """Select the properties of fields of node n, a jsonb value keeps the type graphql returns."""
+    return SQL(', ').join(
+        SQL('n.node_id') if f.name == 'id' else SQL('n._props->{}').format(Literal(f.name)) for f in fields
+    )
+
+
+class PostgresReader(object):
+    """Read the records a GraphQL query returns straight from the node_ and edge_ tables.
+
+    Root records are streamed with a server side cursor ordered by node_id. The links of each page of roots are
+    read with one join over the edge table per link, children are ordered by node_id and limited by `first` as
+    peregrine does, so the records equal the ones read_pages returns.
+    """
+
+    def __init__(self, conn, schema, ddt):
+        self.conn = conn
+        self.schema = schema
+        self.ddt = ddt
+        self.node_table_by_label = ddt.get_node_table_by_label()
+        self.logger = _logger(__name__)
+
+    def _records(self, fields, rows):
+        """Map (node_id, property...) rows to dicts keyed by alias."""
+        properties = [f for f in fields if f.fields is None]
+        return [(row[0], dict(zip([f.alias for f in properties], row[1:]))) for row in rows]
+
+    def _fill_links(self, cur, label, fields, records):
+        """Add the linked records of each field with a selection to [(node_id, record)] of label."""
+        node_ids = [node_id for node_id, _ in records]
+        for link in [f for f in fields if f.fields is not None]:
+            edge_table, parent_column, child_column, child_label = link_join(self.schema, self.ddt, label, link.name)
+            properties = [f for f in link.fields if f.fields is None]
+            query = SQL(
+                "select e.{parent}, n.node_id{comma}{columns}, "
+                "row_number() over (partition by e.{parent} order by n.node_id) as _rank "
+                "from {edge} e join {node} n on n.node_id = e.{child} "
+                "where e.{parent} = any(%s)"
+            ).format(parent=Identifier(parent_column), child=Identifier(child_column),
+                     comma=SQL(', ') if properties else SQL(''), columns=_columns(properties),
+                     edge=Identifier(edge_table), node=Identifier(self.node_table_by_label[child_label]))
+            query = SQL("select * from ({}) linked").format(query)
+            if link.first:
+                query = SQL("{} where _rank <= {}").format(query, Literal(link.first))
+            cur.execute(SQL("{} order by 1, 2;").format(query), (node_ids,))
+            rows = cur.fetchall()
+            # a record linked from two parents is read twice, each parent has its own copy as in graphql
+            child_records = self._records(link.fields, [row[1:-1] for row in rows])
+            self._fill_links(cur, child_label, link.fields, child_records)
+            children = defaultdict(list)
+            for row, (_, child) in zip(rows, child_records):
+                children[row[0]].append(child)
+            for node_id, record in records:
+                record[link.alias] = children.get(node_id, [])
+        # keep the order of the selection
+        for index, (node_id, record) in enumerate(records):
+            records[index] = (node_id, {f.alias: record[f.alias] for f in fields})
+
+    def ids(self, label, page_size, start=None, project_id=None):
+        """Yield pages of the node_ids of label, or those of project_id, ordered by node_id, skipping the first start.
+
+        A server side cursor streams the ids, a page costs the same wherever it is and concurrent inserts do not
+        shift the pages.
+        """
+        cur = self.conn.cursor(name=f"tube_lite_{label}_ids")
+        cur.itersize = page_size
+        cur.execute(SQL("select n.node_id from {node} n{where} order by n.node_id offset %s;").format(
+            node=Identifier(self.node_table_by_label[label]),
+            where=SQL(" where n._props->>'project_id' = %s") if project_id else SQL('')),
+            ((project_id,) if project_id else ()) + (int(start or 0),))
+        while True:
+            rows = cur.fetchmany(page_size)
+            if not rows:
+                break
+            yield [row[0] for row in rows]
+        cur.close()
+        self.conn.commit()
+
+    def read(self, graphql, batch_size=500, start=None, project_id=None):
+        """Yield the records of the root of the query, or those of project_id, batch_size roots and a join per link
+        at a time."""
+        root = parse_query(graphql)
+        label = root.name
+        properties = [f for f in root.fields if f.fields is None]
+        cur = self.conn.cursor()
+        roots = self.conn.cursor(name=f"tube_lite_{label}")
+        roots.itersize = batch_size
+        query = SQL("select n.node_id{comma}{columns} from {node} n{where} order by n.node_id offset %s;").format(
+            comma=SQL(', ') if properties else SQL(''), columns=_columns(properties),
+            node=Identifier(self.node_table_by_label[label]),
+            where=SQL(" where n._props->>'project_id' = %s") if project_id else SQL(''))
+        roots.execute(query, ((project_id,) if project_id else ()) + (int(start or 0),))
+        count = 0
+        started = time.monotonic()
+        while True:
+            rows = roots.fetchmany(batch_size)
+            if not rows:
+                break
+            records = self._records(root.fields, rows)
+            self._fill_links(cur, label, root.fields, records)
+            count += len(records)
+            self.logger.debug(f"{label} {count} records/sec {count / max(time.monotonic() - started, 1e-6):.0f}")
+            yield from (record for _, record in records)
+        roots.close()
+        cur.close()
+        self.conn.commit()
+        self.logger.info(f"{label} {count} records seconds {time.monotonic() - started:.1f}")
@@ -0,0 +1,275 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Iterable, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dictionary import dumps
+
+WORKERS = 4
+"""Default number of batches of a type submitted at the same time."""
+
+MAX_BATCH_SIZE = 1000
+"""Upper bound of records per sheepdog transaction."""
+
+MAX_PAYLOAD_BYTES = 8 * 1024 ** 2
+"""Upper bound of a request body."""
+
+TARGET_SECONDS = 5
+"""Batch size adapts towards sheepdog responding in this many seconds."""
+
+RETRIES = 5
+BACKOFF = 1
+
+TOO_LARGE = {413, 502, 503, 504}
+"""Statuses returned when a transaction is too large or too slow, the batch is split."""
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+_local = threading.local()
+
+
+def session(pool_size=WORKERS):
+    """Return this thread's requests session, connections to sheepdog are kept alive between batches."""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _local.session.mount('https://', adapter)
+        _local.session.mount('http://', adapter)
+    return _local.session
+
+
+class BatchSizer(object):
+    """Thread safe batch size, grows while sheepdog responds faster than target_seconds, shrinks when it is slower
+    or a transaction is rejected."""
+
+    def __init__(self, size=10, minimum=1, maximum=MAX_BATCH_SIZE, target_seconds=TARGET_SECONDS):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.size = max(minimum, min(size, maximum))
+        self.lock = threading.Lock()
+
+    def succeeded(self, count, seconds):
+        """Move towards the size that takes target_seconds at the observed seconds per record, at most doubling."""
+        ideal = self.target_seconds * count / max(seconds, 1e-3)
+        with self.lock:
+            size = min(ideal, self.size * 2) if ideal > self.size else max(ideal, self.size / 2)
+            self.size = max(self.minimum, min(int(size), self.maximum))
+
+    def failed(self, count):
+        """A batch of count records was rejected, halve and never grow back to count."""
+        with self.lock:
+            self.maximum = max(self.minimum, min(self.maximum, count // 2))
+            self.size = max(self.minimum, min(self.size // 2, self.maximum))
+
+
+@dataclass
+class TypeStats(object):
+    """Outcome of submitting, or deleting, the records of one node type."""
+    entity_type: str
+    records: int = 0
+    """Records committed."""
+    failed: int = 0
+    """Records in failed transactions."""
+    requests: int = 0
+    seconds: float = 0
+    batch_size: int = 0
+    """Batch size at the end."""
+
+    def __str__(self):
+        return (f"{self.entity_type} records {self.records} failed {self.failed} requests {self.requests} "
+                f"seconds {self.seconds:.1f} records/sec {self.records / max(self.seconds, 1e-6):.1f} "
+                f"batch_size {self.batch_size}")
+
+
+def log_errors(response_, logger):
+    """Log entity and transactional errors of a sheepdog response."""
+    for entity in response_.get('entities', []):
+        for error in entity.get('errors', []):
+            logger.error('{} {} {}'.format(error.get('type'), entity.get('type'), entity))
+    for error in response_.get('transactional_errors', []):
+        logger.error('transactional_error {}'.format(error))
+
+
+def batches(records: Iterable[dict], sizer: BatchSizer, max_bytes=MAX_PAYLOAD_BYTES):
+    """Yield lists of serialized records, sized by sizer and bounded by max_bytes."""
+    batch = []
+    batch_bytes = 0
+    for record in records:
+        serialized = dumps(record)
+        if batch and (len(batch) >= sizer.size or batch_bytes + len(serialized) > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(serialized)
+        batch_bytes += len(serialized) + 1
+    if batch:
+        yield batch
+
+
+class Submitter(object):
+    """Submit the records of one node type to sheepdog, batches in parallel over pooled connections."""
+
+    def __init__(self, submission_client, program, project, workers=WORKERS, sizer: BatchSizer = None,
+                 max_bytes=MAX_PAYLOAD_BYTES):
+        self.url = f"{submission_client._endpoint}/api/v0/submission/{program}/{project}"
+        self.auth = submission_client._auth_provider
+        self.workers = workers
+        self.sizer = sizer or BatchSizer()
+        self.max_bytes = max_bytes
+        self.logger = _logger(__name__)
+
+    def _put(self, batch: List[str], stats: TypeStats, lock):
+        """Submit one transaction, split it when it is too large, return the number of records committed."""
+        for attempt in range(RETRIES + 1):
+            started = time.monotonic()
+            with lock:
+                stats.requests += 1
+            try:
+                r = session(self.workers).put(self.url, data=f"[{','.join(batch)}]", auth=self.auth,
+                                              headers={'Content-Type': 'application/json'})
+            except requests.RequestException as e:
+                self.logger.warning(f"{type(e).__name__}: {e}")
+                r = None
+                time.sleep(BACKOFF * 2 ** attempt * (1 + random.random()))
+                continue
+            seconds = time.monotonic() - started
+            if r.status_code in (200, 201):
+                self.sizer.succeeded(len(batch), seconds)
+                return len(batch)
+            if r.status_code in TOO_LARGE and len(batch) > 1:
+                self.sizer.failed(len(batch))
+                half = len(batch) // 2
+                return self._put(batch[:half], stats, lock) + self._put(batch[half:], stats, lock)
+            if r.status_code < 500 and r.status_code not in TOO_LARGE:
+                break
+            time.sleep(BACKOFF * 2 ** attempt * (1 + random.random()))
+        if r is not None:
+            try:
+                log_errors(r.json(), self.logger)
+            except ValueError:
+                self.logger.error(f"{r.status_code} {r.text}")
+        with lock:
+            stats.failed += len(batch)
+        return 0
+
+    def submit(self, entity_type, records: Iterable[dict], self_linked=False) -> TypeStats:
+        """Submit all records, return when all transactions have finished.
+
+        Records of a self_linked type, e.g. Organization partOf Organization, may link to a record of an earlier
+        batch, their batches are submitted one at a time in file order.
+        """
+        stats = TypeStats(entity_type)
+        lock = threading.Lock()
+        started = time.monotonic()
+
+        def _done(futures):
+            for future in futures:
+                committed = future.result()
+                with lock:
+                    stats.records += committed
+
+        in_flight = set()
+        max_in_flight = 1 if self_linked else self.workers * 2
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch in batches(records, self.sizer, self.max_bytes):
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    _done(done)
+                in_flight.add(executor.submit(self._put, batch, stats, lock))
+            _done(wait(in_flight).done)
+        stats.seconds = time.monotonic() - started
+        stats.batch_size = self.sizer.size
+        return stats
+
+
+class Deleter(object):
+    """Delete all records of a node type from a project, ids are paged with graphql and deleted in parallel."""
+
+    def __init__(self, submission_client, program, project, workers=WORKERS, batch_size=100, page_size=1000):
+        self.endpoint = submission_client._endpoint
+        self.url = f"{self.endpoint}/api/v0/submission/{program}/{project}/entities"
+        self.auth = submission_client._auth_provider
+        self.project_id = f"{program}-{project}"
+        self.workers = workers
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.logger = _logger(__name__)
+
+    def ids(self, entity_type, offset):
+        """Return a page of ids."""
+        query = f'{{ {entity_type}(project_id: "{self.project_id}", first: {self.page_size}, offset: {offset}) {{ id }} }}'
+        r = session(self.workers).post(f"{self.endpoint}/api/v0/submission/graphql", json={'query': query},
+                                       auth=self.auth)
+        response = r.json()
+        assert r.status_code == 200 and 'errors' not in response, (entity_type, r.status_code, r.text)
+        return [node['id'] for node in response['data'][entity_type]]
+
+    def _delete(self, ids: List[str], stats: TypeStats, lock):
+        """Delete ids in one transaction, on failure bisect to delete all but the ids that fail.
+        Return the number of records deleted."""
+        for attempt in range(RETRIES + 1):
+            with lock:
+                stats.requests += 1
+            try:
+                r = session(self.workers).delete(f"{self.url}/{','.join(ids)}", auth=self.auth)
+            except requests.RequestException as e:
+                self.logger.warning(f"{type(e).__name__}: {e}")
+                r = None
+            if r is not None and r.status_code < 500:
+                break
+            time.sleep(BACKOFF * 2 ** attempt * (1 + random.random()))
+        if r is not None and r.status_code == 200:
+            return len(ids)
+        if len(ids) > 1:
+            half = len(ids) // 2
+            return self._delete(ids[:half], stats, lock) + self._delete(ids[half:], stats, lock)
+        if r is not None:
+            try:
+                log_errors(r.json(), self.logger)
+            except ValueError:
+                self.logger.error(f"{r.status_code} {r.text}")
+        with lock:
+            stats.failed += 1
+        return 0
+
+    def delete(self, entity_type) -> TypeStats:
+        """Delete a page of ids at a time, ids that failed stay in the project so the next page starts after them.
+
+        Pages are repeated while they make progress, records linked to a record of the same type are deleted once
+        that one is gone.
+        """
+        stats = TypeStats(entity_type, batch_size=self.batch_size)
+        lock = threading.Lock()
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                stats.failed = 0
+                deleted = stats.records
+                offset = 0
+                while True:
+                    ids = self.ids(entity_type, offset)
+                    if not ids:
+                        break
+                    futures = [executor.submit(self._delete, ids[i:i + self.batch_size], stats, lock)
+                               for i in range(0, len(ids), self.batch_size)]
+                    page_deleted = sum(future.result() for future in futures)
+                    stats.records += page_deleted
+                    offset += len(ids) - page_deleted
+                    self.logger.info(f"deleting {self.project_id}.{entity_type} deleted {stats.records} "
+                                     f"failed {stats.failed}")
+                if not stats.failed or stats.records == deleted:
+                    break
+        stats.seconds = time.monotonic() - started
+        return stats
@@ -0,0 +1,338 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def _logger(name):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+WORKERS = 8
+"""Default number of files uploading at the same time."""
+
+MULTIPART_THRESHOLD = 100 * 1024 ** 2
+"""Files larger than this are sent with S3 multipart upload."""
+
+PART_SIZE = 64 * 1024 ** 2
+"""Default multipart part size, grown for files that would otherwise need more than MAX_PARTS."""
+
+MAX_PARTS = 10000
+"""S3 limit."""
+
+PART_WORKERS = 4
+"""Default number of parts of a file uploading at the same time."""
+
+BATCH_SIZE = 100
+"""Default number of indexd guids minted together."""
+
+READ_SIZE = 1024 ** 2
+"""Bytes read at a time when a part is hashed and sent."""
+
+
+@dataclass
+class UploadFile(object):
+    """A local file to upload to the gen3 managed bucket and register in indexd."""
+    path: str
+    """Local path."""
+    object_name: str
+    """Name in the bucket and file_name in indexd."""
+    md5: str
+    """Needed for integrity check."""
+    size: int
+    """Needed for indexd."""
+    metadata: Dict[str, str] = field(default_factory=dict)
+    """indexd metadata, also sent as x-amz-meta-* headers."""
+    source: dict = None
+    """Optional, the metadata record this file belongs to."""
+
+
+@dataclass
+class UploadResult(object):
+    """Outcome of a file upload."""
+    upload_file: UploadFile
+    guid: str = None
+    seconds: float = 0
+    error: str = None
+    """None if the file was uploaded and registered."""
+
+
+class Progress(object):
+    """Thread safe counter of uploaded files and bytes, logs files/sec and MB/sec every interval seconds."""
+
+    def __init__(self, total_files, interval=10):
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.errors = 0
+        self.started = time.monotonic()
+        self.logged = self.started
+        self.lock = threading.Lock()
+
+    def update(self, size, error=False):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            self.errors += int(error)
+            now = time.monotonic()
+            if now - self.logged >= self.interval or self.files == self.total_files:
+                self.logged = now
+                _logger(__name__).info(str(self))
+
+    def __str__(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (f"files {self.files}/{self.total_files} errors {self.errors} "
+                f"files/sec {self.files / elapsed:.1f} MB/sec {self.bytes / elapsed / 1024 ** 2:.1f}")
+
+
+_local = threading.local()
+
+
+def session(pool_size=WORKERS):
+    """Return this thread's requests session, connections to the bucket are kept alive between files."""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _local.session.mount('https://', adapter)
+        _local.session.mount('http://', adapter)
+    return _local.session
+
+
+def put_object(signed_url, upload_file):
+    """Upload the file to the signed url."""
+    with open(upload_file.path, 'rb') as data:
+        # When you use this header, Amazon S3 checks the object against the provided MD5 value and,
+        # if they do not match, returns an error.
+        content_md5 = base64.b64encode(bytes.fromhex(upload_file.md5))
+        headers = {'Content-MD5': content_md5}
+        # Our meta data
+        for key, value in upload_file.metadata.items():
+            headers[f"x-amz-meta-{key}"] = value
+        r = session().put(signed_url, data=data, headers=headers)
+        assert r.status_code == 200, (signed_url, r.text)
+
+
+class FileRange(object):
+    """Read only file object over [offset, offset + length) of a file, a part is streamed, not held in memory."""
+
+    def __init__(self, fp, offset, length):
+        self.fd = fp.fileno()
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def __len__(self):
+        return self.length - self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        data = os.pread(self.fd, min(size, self.length - self.position), self.offset + self.position)
+        self.position += len(data)
+        return data
+
+    def md5(self):
+        """Return the md5 of the range, read READ_SIZE at a time."""
+        md5 = hashlib.md5()
+        for offset in range(self.offset, self.offset + self.length, READ_SIZE):
+            md5.update(os.pread(self.fd, min(READ_SIZE, self.offset + self.length - offset), offset))
+        return md5
+
+
+class MultipartUpload(object):
+    """S3 multipart upload through fence's /data/multipart endpoints, resumable.
+
+    Progress is kept in a <path>.upload sidecar file: the guid, upload id and the ETag of each part that
+    is in the bucket, so a rerun only sends the missing parts. Each part is read twice, to hash it and to stream
+    it, so memory does not grow with the part size. Unlike put_object, the object does not carry the
+    x-amz-meta-* headers, the metadata is only in indexd.
+    """
+
+    def __init__(self, file_client, bucket_name, upload_file, part_size=PART_SIZE, part_workers=PART_WORKERS):
+        self.endpoint = file_client._endpoint
+        self.auth = file_client._auth_provider
+        self.bucket_name = bucket_name
+        self.upload_file = upload_file
+        self.part_size = max(part_size, -(-upload_file.size // MAX_PARTS))
+        self.part_workers = part_workers
+        self.state_path = f"{upload_file.path}.upload"
+        self.state = None
+
+    def _post(self, path, body):
+        """Call fence."""
+        r = session().post(f"{self.endpoint}/user/data/multipart/{path}", json=body, auth=self.auth)
+        assert r.status_code in (200, 201), (path, r.text)
+        return r.json() if r.text else {}
+
+    def _save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.state, fp)
+        os.replace(tmp_path, self.state_path)
+
+    def _load_state(self):
+        """Return the state of an unfinished upload of this same file, None if there is none."""
+        if not os.path.isfile(self.state_path):
+            return None
+        with open(self.state_path) as fp:
+            state = json.load(fp)
+        if (state['md5'], state['size'], state['bucket']) != (self.upload_file.md5, self.upload_file.size,
+                                                              self.bucket_name):
+            return None
+        self.part_size = state['part_size']
+        return state
+
+    def _put_part(self, part_number):
+        """Send one part, with its Content-MD5, return its ETag."""
+        offset = (part_number - 1) * self.part_size
+        presigned_url = self._post('upload', {
+            'key': self.state['key'], 'uploadId': self.state['upload_id'], 'partNumber': part_number,
+            'bucket': self.bucket_name,
+        })['presigned_url']
+        with open(self.upload_file.path, 'rb') as fp:
+            data = FileRange(fp, offset, max(0, min(self.part_size, self.upload_file.size - offset)))
+            headers = {'Content-MD5': base64.b64encode(data.md5().digest()).decode(),
+                       'Content-Length': str(len(data))}
+            r = session().put(presigned_url, data=data, headers=headers)
+        assert r.status_code == 200, (presigned_url, r.text)
+        return r.headers['ETag']
+
+    def resumed_guid(self):
+        """Return the guid of an unfinished upload of this same file, None if there is none."""
+        state = self._load_state()
+        return state['guid'] if state else None
+
+    def upload(self, guid=None):
+        """Send the file to the indexd record guid, or to a new blank record, return its guid."""
+        self.state = self._load_state()
+        if self.state:
+            _logger(__name__).info(f"Resuming {self.upload_file.path} {len(self.state['parts'])} parts done")
+        else:
+            body = {'file_name': self.upload_file.object_name, 'bucket': self.bucket_name}
+            if guid:
+                body['guid'] = guid
+            response = self._post('init', body)
+            self.state = {
+                'guid': response['guid'], 'upload_id': response['uploadId'],
+                'key': f"{response['guid']}/{self.upload_file.object_name}",
+                'md5': self.upload_file.md5, 'size': self.upload_file.size, 'bucket': self.bucket_name,
+                'part_size': self.part_size, 'parts': {},
+            }
+            self._save_state()
+
+        part_count = max(1, -(-self.upload_file.size // self.part_size))
+        missing = [n for n in range(1, part_count + 1) if str(n) not in self.state['parts']]
+        lock = threading.Lock()
+
+        def _send(part_number):
+            etag = self._put_part(part_number)
+            with lock:
+                self.state['parts'][str(part_number)] = etag
+                self._save_state()
+
+        with ThreadPoolExecutor(max_workers=self.part_workers) as executor:
+            for future in as_completed([executor.submit(_send, part_number) for part_number in missing]):
+                future.result()
+
+        parts = [{'PartNumber': int(n), 'ETag': etag} for n, etag in sorted(self.state['parts'].items(),
+                                                                             key=lambda item: int(item[0]))]
+        self._post('complete', {'key': self.state['key'], 'uploadId': self.state['upload_id'], 'parts': parts,
+                                'bucket': self.bucket_name})
+        os.unlink(self.state_path)
+        return self.state['guid']
+
+
+def create_record(index_client, bucket_name, program, project, upload_file, guid):
+    """Create the complete indexd record of a file, hashes, size, urls, authz and metadata, with one POST.
+    Return its rev."""
+    upload_file.metadata['datanode_object_id'] = guid
+    r = session().post(f"{index_client.client.url.rstrip('/')}/index/", auth=index_client.client.auth, json={
+        'did': guid,
+        'form': 'object',
+        'hashes': {'md5': upload_file.md5},
+        'size': upload_file.size,
+        'urls': [f"s3://{bucket_name}/{guid}/{upload_file.object_name}"],
+        'file_name': upload_file.object_name,
+        'metadata': upload_file.metadata,
+        'authz': [f'/programs/{program}/projects/{project}'],
+    })
+    assert r.status_code in (200, 201), r.text
+    return r.json()['rev']
+
+
+def put_file(file_client, index_client, bucket_name, program, project, upload_file, guid,
+             multipart_threshold=MULTIPART_THRESHOLD):
+    """Create the indexd record guid and send the file to the bucket, return its guid.
+
+    The record is complete before the object is sent, fence signs the upload for the existing guid, so there is
+    no blank record to update afterwards.
+    """
+    if upload_file.size > multipart_threshold:
+        multipart = MultipartUpload(file_client, bucket_name, upload_file)
+        resumed_guid = multipart.resumed_guid()
+        if resumed_guid:
+            upload_file.metadata['datanode_object_id'] = resumed_guid
+        else:
+            create_record(index_client, bucket_name, program, project, upload_file, guid)
+        guid = multipart.upload(guid)
+    else:
+        rev = create_record(index_client, bucket_name, program, project, upload_file, guid)
+        try:
+            document = file_client.upload_file_to_guid(guid, upload_file.object_name, bucket=bucket_name)
+            assert 'url' in document, document
+            put_object(urllib.parse.unquote(document['url']), upload_file)
+        except Exception:
+            # a record without its object would not resolve
+            session().delete(f"{index_client.client.url.rstrip('/')}/index/{guid}", params={'rev': rev},
+                             auth=index_client.client.auth)
+            raise
+    _logger(__name__).debug(f"Successfully uploaded file \"{upload_file.path}\" to GUID {guid}")
+    return guid
+
+
+def upload(files: List[UploadFile], file_client, index_client, bucket_name, program, project, workers=WORKERS,
+           callback: Callable[[UploadResult], None] = None, multipart_threshold=MULTIPART_THRESHOLD,
+           batch_size=BATCH_SIZE):
+    """Upload files with a pool of workers, each to a complete indexd record, guids are minted batch_size at a
+    time, call callback with each UploadResult as it completes."""
+    progress = Progress(len(files))
+    results = []
+
+    def _put(upload_file, guid):
+        started = time.monotonic()
+        try:
+            guid = put_file(file_client, index_client, bucket_name, program, project, upload_file, guid,
+                            multipart_threshold)
+            return UploadResult(upload_file=upload_file, guid=guid, seconds=time.monotonic() - started)
+        except Exception as e:
+            _logger(__name__).error(f"{upload_file.path} {type(e).__name__}: {e}")
+            return UploadResult(upload_file=upload_file, seconds=time.monotonic() - started,
+                                error=f"{type(e).__name__}: {e}")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for offset in range(0, len(files), batch_size):
+            batch = files[offset:offset + batch_size]
+            guids = index_client.get_valid_guids(count=len(batch))
+            assert len(guids) == len(batch), f"Expected {len(batch)} guids {guids}"
+            futures.extend(executor.submit(_put, upload_file, guid) for upload_file, guid in zip(batch, guids))
+        for future in as_completed(futures):
+            result = future.result()
+            progress.update(result.upload_file.size, error=result.error is not None)
+            if callback:
+                callback(result)
+            results.append(result)
+    return results